@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAI(ThreadingHTTPServer):
+    # Local stand-in for the chat completions endpoint that streams a fixed reply at a set pace.
+    daemon_threads = True
+
+    def __init__(self, ttft=0.05, token_rate=200.0, length=100, port=0):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.length = length
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on streams they no longer want, for example a cancelled hedge.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        received = time.perf_counter()
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        server = self.server
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        if request.get("stream"):
+            self.stream(request, server)
+        else:
+            time.sleep(server.ttft + server.length / server.token_rate)
+            self.send_json(completion(request, "tok " * server.length, server.length))
+        with server.lock:
+            server.requests.append({"seconds": time.perf_counter() - received, "tokens": server.length})
+
+    def stream(self, request, server):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(server.ttft)
+        for i in range(server.length):
+            if i:
+                time.sleep(1 / server.token_rate)
+            self.send_chunk(chunk(request, {"content": "tok "}, None))
+        self.send_chunk(chunk(request, {}, "stop"))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def send_chunk(self, data):
+        self.write_chunk(f"data: {json.dumps(data)}\n\n".encode())
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def chunk(request, delta, finish_reason):
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def completion(request, text, tokens):
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+class Timers:
+    # Wraps functions in place and accumulates their time into the current turn's buckets.
+    def __init__(self):
+        self.buckets = {}
+
+    def wrap(self, owner, name, bucket):
+        original = getattr(owner, name)
+        buckets = self.buckets
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                buckets[bucket] = buckets.get(bucket, 0.0) + time.perf_counter() - t0
+
+        setattr(owner, name, timed)
+
+    def take(self):
+        buckets = dict(self.buckets)
+        self.buckets.clear()
+        return buckets
+
+
+def slope(ys):
+    n = len(ys)
+    if n < 2:
+        return 0.0
+    mean_x = (n - 1) / 2
+    mean_y = sum(ys) / n
+    return sum((x - mean_x) * (y - mean_y) for x, y in enumerate(ys)) / sum((x - mean_x) ** 2 for x in range(n))
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def cold_start(backend, ttft, token_rate, length):
+    # Time to the first token of the first turn in a fresh interpreter, so imports and client setup
+    # count wherever each backend defers them. Includes the mock's own time to first token.
+    # The probe gets its own server so its request is not mistaken for one of the measured turns.
+    server = MockOpenAI(ttft=ttft, token_rate=token_rate, length=length).start()
+    env = {**os.environ, "OPENAI_API_BASE": server.url, "OPENAI_BASE_URL": server.url}
+    code = (
+        "import time; t0 = time.perf_counter(); import ode_to_galileo; "
+        f"speaker = ode_to_galileo.make_speakers('x', backend={backend!r})[0]; "
+        "speaker.callback.silent = True; speaker.run('Hello.'); print(speaker.callback.stamps[0] - t0)"
+    )
+    try:
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    finally:
+        server.shutdown()
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def instrument(ode_to_galileo, timers, turns, backend):
+    if backend == "langchain":
+        from langchain.prompts import PromptTemplate
+
+        timers.wrap(PromptTemplate, "format", "prompt_render")
+    else:
+        timers.wrap(ode_to_galileo.Template, "format", "prompt_render")
+    timers.wrap(ode_to_galileo.TranscriptView, "load_memory_variables", "memory")
+    timers.wrap(ode_to_galileo.TranscriptView, "save_context", "memory")
+    timers.wrap(ode_to_galileo.Callback, "on_llm_new_token", "print")
+
+    run = ode_to_galileo.Speaker.run
+
+    def timed_run(speaker, _input):
+        timers.take()
+        t0 = time.perf_counter()
+        response = run(speaker, _input)
+        turns.append({"speaker": speaker.name, "wall": time.perf_counter() - t0, **timers.take()})
+        return response
+
+    ode_to_galileo.Speaker.run = timed_run
+
+
+def run_benchmark(turns=20, ttft=0.05, token_rate=200.0, length=100, topic="the pendulum", backend="langchain"):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    startup = cold_start(backend, ttft, token_rate, length)
+
+    server = MockOpenAI(ttft=ttft, token_rate=token_rate, length=length).start()
+    os.environ["OPENAI_API_BASE"] = server.url
+    os.environ["OPENAI_BASE_URL"] = server.url
+
+    import ode_to_galileo
+
+    timers = Timers()
+    results = []
+    instrument(ode_to_galileo, timers, results, backend)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            ode_to_galileo.main(topic, turns=turns, backend=backend)
+    finally:
+        server.shutdown()
+
+    for i, (turn, request) in enumerate(zip(results, server.requests)):
+        turn["turn"] = i
+        turn["server"] = request["seconds"]
+        turn["tokens"] = request["tokens"]
+        turn["overhead"] = turn["wall"] - request["seconds"]
+        turn["overhead_per_token"] = turn["overhead"] / request["tokens"]
+        # Whatever client time is not spent rendering, in memory or printing goes to the backend itself.
+        turn["chain"] = turn["overhead"] - sum(turn.get(name, 0.0) for name in ("prompt_render", "memory", "print"))
+
+    components = ("wall", "overhead", "chain", "prompt_render", "memory", "print")
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {"backend": backend, "turns": turns, "ttft": ttft, "token_rate": token_rate, "length": length},
+        "cold_start": startup,
+        "cold_start_overhead": startup - ttft,
+        "turns": results,
+        "summary": {
+            name: {
+                "mean": sum(turn.get(name, 0.0) for turn in results) / len(results),
+                "growth_per_turn": slope([turn.get(name, 0.0) for turn in results]),
+            }
+            for name in components
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure client-side overhead against a local mock OpenAI server")
+
+    parser.add_argument("--backend", choices=("langchain", "native"), default="langchain", help="Backend to measure")
+    parser.add_argument("--turns", type=int, default=20, help="Turns per dialogue")
+    parser.add_argument("--ttft", type=float, default=0.05, help="Mock time to first token in seconds")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Mock tokens per second")
+    parser.add_argument("--length", type=int, default=100, help="Mock tokens per response")
+    parser.add_argument("--output", type=str, default="bench_output.json", help="Where to write the JSON results")
+
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        turns=args.turns, ttft=args.ttft, token_rate=args.token_rate, length=args.length, backend=args.backend
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'cold_start':>14}: {results['cold_start'] * 1000:8.2f} ms "
+          f"({results['cold_start_overhead'] * 1000:.2f} ms excluding the mock's time to first token)", file=sys.stderr)
+    for name, summary in results["summary"].items():
+        print(f"{name:>14}: mean {summary['mean'] * 1000:8.2f} ms, growth {summary['growth_per_turn'] * 1000:+.3f} ms/turn",
+              file=sys.stderr)
@@ -1,21 +1,238 @@
-import openai
 import os
+import re
+import json
+import time
+import queue
+import random
+import logging
+import hashlib
+import sqlite3
+import asyncio
 import argparse
+import threading
+import weakref
+import itertools
+import functools
+import contextlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from termcolor import colored
-from langchain.memory import ConversationBufferMemory
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.prompts import PromptTemplate
-from langchain.callbacks.base import BaseCallbackHandler
 
 
-class Callback(BaseCallbackHandler):
+# The Attempt a worker thread is running for Resilience, if any.
+current_attempt = threading.local()
+
+
+class Callback:
 
     def __init__(self, color):
         self.color = color
+        # Panellists answering at the same time are printed once they are done instead.
+        self.silent = False
+        # Arrival time of every token in the current turn, kept unboxed to stay cheap per token.
+        self.stamps = array("d")
 
     def on_llm_new_token(self, token: str, **kwargs):
-        print(colored(token, self.color), end="")
+        attempt = getattr(current_attempt, "value", None)
+        if attempt is not None:
+            attempt.put(token)
+        else:
+            self.emit(token)
+
+    def on_llm_end(self, *args, **kwargs):
+        # Stops a cancelled attempt before its response is saved to memory.
+        attempt = getattr(current_attempt, "value", None)
+        if attempt is not None:
+            attempt.race.commit(attempt)
+
+    def emit(self, token):
+        self.stamps.append(time.perf_counter())
+        if not self.silent:
+            print(colored(token, self.color), end="")
+
+    def reset(self):
+        del self.stamps[:]
+
+
+@functools.lru_cache(maxsize=None)
+def langchain_callback_handler():
+    from langchain.callbacks.base import BaseCallbackHandler
+    from langchain.callbacks.manager import handle_event
+
+    # Cancelling an attempt raises from the handler on purpose, so that is not worth a warning.
+    logging.getLogger(handle_event.__module__).addFilter(lambda record: "Cancelled()" not in record.getMessage())
+
+    class CallbackHandler(BaseCallbackHandler):
+        # Forwards langchain's streaming events to a Callback.
+        # Errors are raised so that cancelling an attempt aborts the chain.
+        raise_error = True
+
+        def __init__(self, callback):
+            self.callback = callback
+
+        def on_llm_new_token(self, token: str, **kwargs):
+            self.callback.on_llm_new_token(token)
+
+        def on_llm_end(self, response, **kwargs):
+            self.callback.on_llm_end()
+
+    return CallbackHandler
+
+
+# USD per 1K prompt and completion tokens.
+PRICES = {
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Reservoir:
+    # A uniform sample of at most `size` values for quantiles, with the exact count and sum.
+    def __init__(self, size=1024):
+        self.size = size
+        self.values = array("d")
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                self.values[i] = value
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    def quantiles(self, qs):
+        ordered = sorted(self.values)
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0 for q in qs]
+
+
+class Metrics:
+    # Per-turn latency, token and cost figures for every speaker, exported in Prometheus text format.
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.speakers = {}
+        self.lock = threading.Lock()
+
+    def record(self, speaker, prompt_tokens, completion_tokens, start, seconds):
+        model = speaker.model
+        stamps = speaker.callback.stamps if speaker.callback else ()
+        prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+        cost = 0.0 if speaker.cached else (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        with self.lock:
+            stats = self.speakers.setdefault(speaker.name, {
+                "model": model, "turns": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0,
+                "seconds": 0.0, "ttft": Reservoir(), "itl": Reservoir(), "tokens_per_second": 0.0,
+            })
+            stats["turns"] += 1
+            stats["cached"] += speaker.cached
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cost"] += cost
+            stats["seconds"] += seconds
+            if speaker.cached or not stamps:
+                # Replayed turns say nothing about the model's latency, and unstreamed batch turns have no token times.
+                return
+            ttft = stamps[0] - start
+            generating = stamps[-1] - stamps[0] if len(stamps) > 1 else seconds - ttft
+            stats["ttft"].add(ttft)
+            stats["itl"].extend(b - a for a, b in zip(stamps, stamps[1:]))
+            stats["tokens_per_second"] = completion_tokens / generating if generating > 0 else 0.0
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append(f"# HELP galileo_{name} {help}")
+            lines.append(f"# TYPE galileo_{name} {kind}")
+            for labels, value in values:
+                label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"galileo_{name}{{{label}}} {value}")
+
+        def quantiles(name, help, key):
+            values = []
+            for speaker, stats in self.speakers.items():
+                labels = {"speaker": speaker, "model": stats["model"]}
+                for q, value in zip(self.QUANTILES, stats[key].quantiles(self.QUANTILES)):
+                    values.append(({**labels, "quantile": q}, value))
+            metric(name, "summary", help, values)
+            for speaker, stats in self.speakers.items():
+                label = f'speaker="{speaker}",model="{stats["model"]}"'
+                lines.append(f"galileo_{name}_sum{{{label}}} {stats[key].sum}")
+                lines.append(f"galileo_{name}_count{{{label}}} {stats[key].count}")
+
+        def counter(name, help, key, kind="counter"):
+            metric(name, kind, help, [
+                ({"speaker": speaker, "model": stats["model"]}, stats[key]) for speaker, stats in self.speakers.items()
+            ])
+
+        with self.lock:
+            counter("turns_total", "Completed turns.", "turns")
+            counter("cached_turns_total", "Turns replayed from the response cache.", "cached")
+            counter("prompt_tokens_total", "Prompt tokens sent.", "prompt_tokens")
+            counter("completion_tokens_total", "Completion tokens received.", "completion_tokens")
+            counter("cost_usd_total", "Estimated spend in USD.", "cost")
+            counter("turn_seconds_total", "Wall time spent in turns.", "seconds")
+            counter("tokens_per_second", "Streaming rate of the last turn.", "tokens_per_second", kind="gauge")
+            quantiles("time_to_first_token_seconds", "Time from request to first token.", "ttft")
+            quantiles("inter_token_latency_seconds", "Time between consecutive tokens.", "itl")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            for speaker, stats in self.speakers.items():
+                latency = ""
+                if stats["ttft"].count:
+                    ttft, = stats["ttft"].quantiles((0.5,))
+                    itl_p50, itl_p99 = stats["itl"].quantiles((0.5, 0.99))
+                    latency = f"ttft p50 {ttft:.2f}s, itl p50/p99 {itl_p50 * 1000:.0f}/{itl_p99 * 1000:.0f}ms, "
+                lines.append(
+                    f"{speaker} ({stats['model']}): {stats['turns']} turns, {latency}"
+                    f"{stats['prompt_tokens']}+{stats['completion_tokens']} tokens, ${stats['cost']:.4f}"
+                )
+            lines.append(f"total: ${sum(stats['cost'] for stats in self.speakers.values()):.4f}")
+        return "\n".join(lines)
 
 
 simplicio_system_message = """
@@ -47,67 +264,1218 @@ Simplicio:
 Salvati:\n
 """
 
-def toggle(a, b, yield_a=True):
-    while True:
-        (yield a) if yield_a else (yield b)
-        yield_a = not yield_a
+simplicio_panel_system_message = """
+Your name is Simplicio.
+You are curious, albeit limited in congitive abilities, but moves the conversation forward with your intriguing questions.
+You want to know more about {topic} and really want to understand and grok it. You are in a chat with a panel of experts on these things, named {experts}, and want to pick their brains on these matters. Please be inquisitive and ask as many relevant questions as you can
+to keep the conversation going forward.
+
+Current conversation:
+{{history}}
+
+{{input}}
+
+Simplicio:\n
+"""
+
+expert_system_message = """
+Your name is {name}.
+{persona}
+You are on a panel with {others}, talking to a curious person that wants to know about certain subjects. His name is Simplicio. Please be informative and conversational in your exploration of his questions, and build on what the others say.
+
+Current conversation:
+{{history}}
+
+{{input}}
+
+{name}:\n
+"""
+
+salvati_persona = "You are a polymath with wast knowledge of all cerebral subjects known to man. You like to explain things and moves the converstation forward with your insights."
+
+
+class RoundRobin:
+    # Every speaker in turn, like toggle() did for two.
+    def __init__(self, speakers):
+        self.speakers = speakers
+        self.index = -1
+
+    def next(self, message):
+        self.index = (self.index + 1) % len(self.speakers)
+        return self.speakers[self.index]
+
+    def seen(self, speaker):
+        self.index = self.speakers.index(speaker)
+
+
+class Weighted:
+    # A random speaker other than the previous one, drawn in proportion to its weight.
+    def __init__(self, speakers, weights=None):
+        self.speakers = speakers
+        self.weights = weights or [1.0] * len(speakers)
+        self.previous = None
+
+    def next(self, message):
+        if self.previous is None:
+            speaker = self.speakers[0]
+        else:
+            candidates = [(s, w) for s, w in zip(self.speakers, self.weights) if s is not self.previous]
+            speaker = random.choices([s for s, _ in candidates], [w for _, w in candidates])[0]
+        self.previous = speaker
+        return speaker
+
+    def seen(self, speaker):
+        self.previous = speaker
+
+
+moderator_message = """
+You are moderating a conversation between {names}.
+The last message, from {speaker}, was:
+{message}
+
+Who should speak next? Answer with exactly one name from: {candidates}.
+"""
+
+
+class Moderated:
+    # A moderator model picks the next speaker from the last message, falling back to round robin.
+    def __init__(self, speakers, complete):
+        self.speakers = speakers
+        self.complete = complete
+        self.fallback = RoundRobin(speakers)
+        self.previous = None
+
+    def next(self, message):
+        speaker = None
+        candidates = [s for s in self.speakers if s is not self.previous]
+        if len(candidates) == 1:
+            # Nothing for the moderator to decide, as always with two speakers.
+            speaker = candidates[0]
+        elif self.previous is not None:
+            answer = self.complete(moderator_message.format(
+                names=", ".join(s.name for s in self.speakers),
+                speaker=self.previous.name,
+                message=message,
+                candidates=", ".join(s.name for s in candidates),
+            )).lower()
+            speaker = next((s for s in candidates if s.name.lower() in answer), None)
+        if speaker is None:
+            speaker = self.fallback.next(message)
+            if speaker is self.previous:
+                speaker = self.fallback.next(message)
+        self.seen(speaker)
+        return speaker
+
+    def seen(self, speaker):
+        self.previous = speaker
+        self.fallback.seen(speaker)
+
+
+POLICIES = ("round-robin", "weighted", "moderator")
+
+
+def make_scheduler(policy, speakers, weights=None, complete=None):
+    if policy == "round-robin":
+        return RoundRobin(speakers)
+    if policy == "weighted":
+        return Weighted(speakers, weights)
+    if policy == "moderator":
+        return Moderated(speakers, complete)
+    raise ValueError(f"Unknown scheduling policy: {policy}")
+
+
+def make_completer(backend, model="gpt-3.5-turbo-16k"):
+    # A plain, unstreamed completion function, used by the moderator.
+    if backend == "native":
+        def complete(prompt):
+            completion = openai_client().chat.completions.create(
+                model=model, temperature=0, messages=[{"role": "user", "content": prompt}]
+            )
+            return completion.choices[0].message.content or ""
+        return complete
+
+    from langchain.chat_models import ChatOpenAI
+
+    return ChatOpenAI(model=model, temperature=0).predict
+
+
+class RateLimiter:
+    # Caps concurrent requests and the requests/tokens spent in any 60 second window for one model.
+    def __init__(self, concurrency, rpm=None, tpm=None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()
+        self.lock = asyncio.Lock()
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.window.popleft()
+
+    async def wait(self, tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                requests = sum(r for _, r, _ in self.window)
+                used = sum(t for _, _, t in self.window)
+                if (not self.rpm or requests < self.rpm) and (not self.tpm or not self.window or used + tokens <= self.tpm):
+                    self.window.append((now, 1, tokens))
+                    return
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+
+    def add(self, tokens):
+        self.window.append((time.monotonic(), 0, tokens))
+
+
+class ResponseCache:
+    # Completions stored on disk under a hash of model, temperature and rendered prompt,
+    # evicted least recently used first once older than max_age seconds or over max_bytes.
+    def __init__(self, path, max_bytes=None, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # Panellists answer from worker threads, so the connection is shared behind a lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    @staticmethod
+    def key(model, temperature, prompt):
+        return hashlib.sha256(json.dumps([model, temperature, prompt]).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, response, len(response.encode()), now, now),
+                )
+        self.evict()
+
+    def evict(self):
+        with self.lock, self.db:
+            if self.max_age is not None:
+                self.db.execute("DELETE FROM responses WHERE accessed < ?", (time.time() - self.max_age,))
+            if self.max_bytes is not None:
+                (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+                if total > self.max_bytes:
+                    stale = []
+                    for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        total -= size
+                    self.db.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self):
+        self.db.close()
+
+
+class TranscriptLog:
+    # Append-only JSONL log: a header line with the topic, then one line per completed turn.
+    def __init__(self, path, topic, resume=False):
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # Appending a new dialogue to an old one would mix the two up on the next resume.
+            if not resume:
+                raise ValueError(f"{path} already holds a dialogue; continue it with --resume or log to a new file")
+            if self.read(path)[0].get("topic") != topic:
+                raise ValueError(f"{path} is a dialogue about a different topic")
+            # Drop a half-written last line, or everything appended after it would be unreadable.
+            with open(path, "rb+") as f:
+                f.truncate(f.read().rfind(b"\n") + 1)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a")
+        if new:
+            self.write({"topic": topic})
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        try:
+            header, turns = json.loads(lines[0]), []
+        except (IndexError, json.JSONDecodeError):
+            raise ValueError(f"{path} has no transcript log header") from None
+        for line in lines[1:]:
+            try:
+                turns.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A crash can leave the last line half written.
+                break
+        return header, turns
+
+
+@functools.lru_cache(maxsize=None)
+def encoding_for(model):
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        # tiktoken is optional and downloads its encodings on first use, so estimate when it is unavailable.
+        return None
+
+
+def count_tokens(model, text):
+    encoding = encoding_for(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class Stalled(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Race:
+    # The attempts of one turn. Only one of them wins, and only the winner may save its response to memory.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.winner = None
+        self.committed = False
+        self.abandoned = False
+
+    def claim(self, attempt):
+        with self.lock:
+            if self.winner is None and not self.abandoned:
+                self.winner = attempt
+            return self.winner is attempt
+
+    def commit(self, attempt):
+        # Called by an attempt right before it saves, so the caller cannot give up on it halfway.
+        with self.lock:
+            if self.abandoned or self.winner not in (None, attempt):
+                raise Cancelled()
+            self.winner = attempt
+            self.committed = True
+
+    def abandon(self):
+        # False once the winner is saving its response, which then has to be waited for.
+        with self.lock:
+            if not self.committed:
+                self.abandoned = True
+            return self.abandoned
+
+
+class Attempt:
+    # One request running in a worker thread, reporting (attempt, kind, value) events to the caller.
+    def __init__(self, events, race):
+        self.events = events
+        self.race = race
+
+    @property
+    def cancelled(self):
+        return self.race.abandoned or self.race.winner not in (None, self)
+
+    def put(self, token):
+        if self.cancelled:
+            raise Cancelled()
+        self.events.put((self, "token", token))
+
+    def start(self, call):
+        def target():
+            current_attempt.value = self
+            try:
+                self.events.put((self, "done", call()))
+            except BaseException as e:
+                self.events.put((self, "error", e))
+
+        threading.Thread(target=target, daemon=True).start()
+        return self
+
+
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+def retryable(error):
+    if isinstance(error, Stalled):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    import openai
+
+    return isinstance(error, openai.APIConnectionError)
+
+
+class Resilience:
+    # Deadlines, retries and hedging for one speaker's turns. Every attempt runs in a worker thread
+    # and streams its tokens back through a queue, so a stalled attempt can be abandoned and a
+    # duplicate raced against a slow one without either touching the output or the memory.
+    def __init__(self, ttft_timeout=60.0, stall_timeout=30.0, retries=5, backoff=1.0, max_backoff=60.0,
+                 hedge=False, hedge_quantile=0.95, hedge_samples=10):
+        self.ttft_timeout = ttft_timeout
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_samples = hedge_samples
+        self.ttfts = deque(maxlen=200)
+        self.hedged = 0
+
+    def client_options(self):
+        # Socket timeouts as a backstop for abandoned attempts, and no retries below this layer.
+        return {"max_retries": 0, "timeout": max(self.ttft_timeout, self.stall_timeout)}
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.ttfts) < self.hedge_samples:
+            return None
+        return percentile(self.ttfts, self.hedge_quantile)
+
+    def delay(self, retry, error):
+        wait = retry_after(error)
+        if wait is not None:
+            return wait + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+    def run(self, call, callback):
+        for retry in range(self.retries + 1):
+            race = Race()
+            try:
+                return self.attempt(call, callback, race)
+            except Exception as e:
+                # Once a response is accepted it is never generated again, even if saving it to memory failed.
+                if race.committed or retry == self.retries or not retryable(e):
+                    raise
+                wait = self.delay(retry, e)
+                # Tokens already printed by the failed attempt are not part of the answer.
+                discarded = callback is not None and len(callback.stamps) > 0
+                if callback:
+                    callback.reset()
+                note = "; discarding the partial answer" if discarded else ""
+                print(("\n" if discarded and not callback.silent else "")
+                      + colored(f"[{e.__class__.__name__}: {e}{note}; retrying in {wait:.1f}s]", "grey"))
+                time.sleep(wait)
+
+    def attempt(self, call, callback, race):
+        events = queue.SimpleQueue()
+        start = time.perf_counter()
+        attempts = [Attempt(events, race).start(call)]
+        failed = set()
+        hedge_delay = self.hedge_delay()
+        started = False
+        last = start
+        try:
+            while True:
+                if race.committed:
+                    # The winner is already saving its response, so no deadline applies any more.
+                    deadline = None
+                elif not started:
+                    deadline = start + self.ttft_timeout
+                    if hedge_delay is not None and len(attempts) == 1:
+                        deadline = min(deadline, start + hedge_delay)
+                else:
+                    deadline = last + self.stall_timeout
+                try:
+                    timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                    attempt, kind, value = events.get(timeout=timeout)
+                except queue.Empty:
+                    if not started and hedge_delay is not None and len(attempts) == 1:
+                        self.hedged += 1
+                        attempts.append(Attempt(events, race).start(call))
+                        continue
+                    if not race.abandon():
+                        continue
+                    if not started:
+                        raise Stalled(f"no first token within {self.ttft_timeout:g}s")
+                    raise Stalled(f"no token for {self.stall_timeout:g}s")
+                if kind == "error":
+                    failed.add(attempt)
+                    if race.winner not in (None, attempt) or (race.winner is None and len(failed) < len(attempts)):
+                        continue
+                    raise value
+                # The first attempt to produce anything wins and the others are dropped.
+                if not race.claim(attempt):
+                    continue
+                if not started:
+                    started = True
+                    self.ttfts.append(time.perf_counter() - start)
+                if kind == "token":
+                    last = time.perf_counter()
+                    if callback:
+                        callback.emit(value)
+                else:
+                    return value
+        finally:
+            race.abandon()
 
 
 class Speaker:
-    def __init__(self, name, color, agent):
+    def __init__(self, name, color, agent, model, temperature, limiter=None, cache=None, callback=None,
+                 resilience=None, transcript=None):
         self.name = name
         self.color = color
         self.agent = agent
+        self.transcript = transcript
+        self.model = model
+        self.temperature = temperature
+        self.limiter = limiter
+        self.cache = cache
+        self.callback = callback
+        self.resilience = resilience
+        self.cached = False
 
     def run(self, _input):
-        return self.agent.run(_input)
+        if self.callback:
+            self.callback.reset()
+        self.cached = False
+        if self.cache is None:
+            return self.call(_input)
+        key = self.cache_key(_input)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.call(_input)
+            self.cache.put(key, response)
+        else:
+            self.cached = True
+            self.replay(_input, response)
+        return response
+
+    async def arun(self, _input):
+        self.cached = False
+        if self.cache is not None:
+            key = self.cache_key(_input)
+            response = self.cache.get(key)
+            if response is not None:
+                self.cached = True
+                await asyncio.to_thread(self.replay, _input, response)
+                return response
+        if self.limiter is None:
+            response = await self.acall(_input)
+        else:
+            async with self.limiter.semaphore:
+                await self.limiter.wait(self.prompt_tokens(_input))
+                response = await self.acall(_input)
+            self.limiter.add(self.completion_tokens(response))
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+    def call(self, _input):
+        if self.resilience is None:
+            return self.agent.run(_input)
+        return self.resilience.run(lambda: self.agent.run(_input), self.callback)
+
+    async def acall(self, _input):
+        memory = self.agent.memory
+        if not hasattr(memory, "predict_new_summary"):
+            return await self.agent.arun(_input)
+        # Summary memories call the model from save_context, which is synchronous in langchain.
+        # Run the chain without its memory and save in a thread, so the event loop keeps serving other dialogues.
+        history = memory.load_memory_variables({})
+        self.agent.memory = None
+        try:
+            response = await self.agent.arun(input=_input, **history)
+        finally:
+            self.agent.memory = memory
+        await asyncio.to_thread(memory.save_context, {"input": _input}, {"response": response})
+        return response
+
+    def replay(self, _input, response):
+        # Feed a cached completion through the streaming callbacks and memory as if it had just been generated.
+        if self.callback:
+            for token in re.findall(r"\s*\S+", response):
+                self.callback.emit(token)
+        self.agent.memory.save_context({"input": _input}, {"response": response})
+
+    def render(self, _input):
+        history = self.agent.memory.load_memory_variables({})
+        return self.agent.prompt.format(input=_input, **history)
+
+    def cache_key(self, _input):
+        return self.cache.key(self.model, self.temperature, self.render(_input))
+
+    def prompt_tokens(self, _input):
+        return count_tokens(self.model, self.render(_input))
+
+    def completion_tokens(self, response):
+        return count_tokens(self.model, response)
+
+
+class Transcript:
+    # The dialogue stored once and shared by every speaker.
+    def __init__(self):
+        self.speakers = []
+        self.texts = []
+        # Size of the latest group of lines, which together are the next speaker's input.
+        self.group = 0
+        self.staged = None
+
+    def append(self, speaker, text):
+        if self.staged is not None:
+            self.staged.append((speaker, text))
+            return
+        self.speakers.append(speaker)
+        self.texts.append(text)
+        self.group = 1
+
+    @contextlib.contextmanager
+    def round(self, order):
+        # Holds back lines said at the same time, so every panellist sees the same history,
+        # then adds them in the given speaker order as one group.
+        self.staged = []
+        try:
+            yield
+            staged = self.staged
+        finally:
+            self.staged = None
+        staged.sort(key=lambda line: order.index(line[0]))
+        for speaker, text in staged:
+            self.speakers.append(speaker)
+            self.texts.append(text)
+        if staged:
+            self.group = len(staged)
+
+    def __len__(self):
+        return len(self.texts)
+
+
+class TranscriptView:
+    # One speaker's view of a shared Transcript: its own lines as AI, everyone else's as Human,
+    # or by name when there are several others.
+    # The rendered history is cached and only new turns are appended to it, so it is a stable prefix.
+    memory_key = "history"
+    human_prefix = "Human"
+    ai_prefix = "AI"
+
+    def __init__(self, transcript, speaker, names=False):
+        self.transcript = transcript
+        self.speaker = speaker
+        self.names = names
+        self.rendered = ""
+        self.rendered_turns = 0
+
+    def prefix(self, speaker):
+        if speaker == self.speaker:
+            return self.ai_prefix
+        return speaker if self.names else self.human_prefix
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        transcript = self.transcript
+        end = len(transcript)
+        # The latest lines by other speakers are the pending input, which the prompt shows on its own.
+        if end and self.speaker not in transcript.speakers[end - transcript.group:]:
+            end -= transcript.group
+        if self.rendered_turns < end:
+            lines = [
+                f"{self.prefix(speaker)}: {text}"
+                for speaker, text in zip(transcript.speakers[self.rendered_turns:end], transcript.texts[self.rendered_turns:end])
+            ]
+            self.rendered = "\n".join([self.rendered, *lines]) if self.rendered else "\n".join(lines)
+            self.rendered_turns = end
+        return {self.memory_key: self.rendered}
+
+    def save_context(self, inputs, outputs):
+        # The input is already in the transcript as the previous speaker's response.
+        self.transcript.append(self.speaker, outputs["response"])
+
+    def clear(self):
+        self.rendered = ""
+        self.rendered_turns = 0
+
+
+@functools.lru_cache(maxsize=None)
+def langchain_transcript_memory():
+    from langchain.schema import BaseMemory
+
+    class TranscriptMemory(BaseMemory):
+        # Exposes a TranscriptView as the memory ConversationChain expects.
+        view: TranscriptView
+
+        @property
+        def memory_variables(self):
+            return self.view.memory_variables
+
+        def load_memory_variables(self, inputs):
+            return self.view.load_memory_variables(inputs)
+
+        def save_context(self, inputs, outputs):
+            self.view.save_context(inputs, outputs)
+
+        def clear(self):
+            self.view.clear()
+
+    return TranscriptMemory
+
+
+MEMORY_MODES = ("buffer", "window", "summary", "hybrid")
+BACKENDS = ("langchain", "native")
+
+
+def make_memory(mode, history_tokens, transcript, speaker, summary_llm=None, names=False):
+    # buffer: full history in a transcript shared by all speakers,
+    # window: newest turns within the token budget, summary: running summary only,
+    # hybrid: newest turns verbatim within the token budget with older turns folded into a running summary.
+    if mode == "buffer":
+        return TranscriptView(transcript, speaker, names)
+
+    from langchain.memory import (
+        ConversationTokenBufferMemory,
+        ConversationSummaryMemory,
+        ConversationSummaryBufferMemory,
+    )
 
+    if mode == "window":
+        return ConversationTokenBufferMemory(
+            llm=summary_llm, max_token_limit=history_tokens, memory_key="history"
+        )
+    if mode == "summary":
+        return ConversationSummaryMemory(llm=summary_llm, memory_key="history")
+    if mode == "hybrid":
+        return ConversationSummaryBufferMemory(
+            llm=summary_llm, max_token_limit=history_tokens, memory_key="history"
+        )
+    raise ValueError(f"Unknown memory mode: {mode}")
 
-def main(topic):
-    simplicio_memory = ConversationBufferMemory(memory_key="history", return_messages=True)
-    simplicio_llm = ChatOpenAI(model="gpt-3.5-turbo-16k", temperature=0.7, streaming=True, callbacks=[Callback("red")])
-    simplicio_agent = ConversationChain(
-        llm=simplicio_llm, 
-        memory=simplicio_memory, 
-        prompt=PromptTemplate(input_variables=["input", "history"], template=simplicio_system_message.format(topic=topic))
-    )
 
-    salviati_memory = ConversationBufferMemory(memory_key="history", return_messages=True)
-    salviati_llm = ChatOpenAI(model="gpt-4", temperature=0.7, streaming=True, callbacks=[Callback("green")])
-    salviati_agent = ConversationChain(
-        llm=salviati_llm, 
-        memory=salviati_memory, 
-        prompt=PromptTemplate(input_variables=["input", "history"], template=salvati_system_message)
-    )
+class Template:
+    # str.format-based stand-in for langchain's PromptTemplate.
+    def __init__(self, template):
+        self.template = template
+
+    def format(self, **kwargs):
+        return self.template.format(**kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def openai_client():
+    # One client, and with it one keep-alive connection pool, shared by every native speaker.
+    import openai
 
-    simplicio = Speaker("Simplicio", "red", simplicio_agent)
-    salviati = Speaker("Salvati", "green", salviati_agent)
+    return openai.OpenAI(base_url=os.environ.get("OPENAI_API_BASE"))
 
-    toggle_speaker = toggle(simplicio, salviati)
-    speaker = next(toggle_speaker)
-    print(colored(speaker.name, speaker.color))
-    message = speaker.run("Hello.")
-    print()
-    while True:
-        speaker = next(toggle_speaker)
-        print(colored(speaker.name, speaker.color))
-        message = speaker.run(message)
-        print()
 
+async_openai_clients = weakref.WeakKeyDictionary()
+
+
+def async_openai_client():
+    # Shared the same way, but an async client is tied to the event loop it was first used on.
+    import openai
+
+    loop = asyncio.get_running_loop()
+    if loop not in async_openai_clients:
+        async_openai_clients[loop] = openai.AsyncOpenAI(base_url=os.environ.get("OPENAI_API_BASE"))
+    return async_openai_clients[loop]
+
+
+class NativeAgent:
+    # Talks to the openai client directly, rendering the prompt and updating memory the way ConversationChain does.
+    def __init__(self, model, temperature, prompt, memory, callback=None, client_options=None):
+        self.model = model
+        self.temperature = temperature
+        self.prompt = prompt
+        self.memory = memory
+        self.callback = callback
+        self.client_options = client_options
+        self.client = None
+
+    def messages(self, _input):
+        history = self.memory.load_memory_variables({})
+        return [{"role": "user", "content": self.prompt.format(input=_input, **history)}]
+
+    def run(self, _input):
+        if self.client is None:
+            client = openai_client()
+            self.client = client.with_options(**self.client_options) if self.client_options else client
+        stream = self.client.chat.completions.create(
+            model=self.model, temperature=self.temperature, messages=self.messages(_input), stream=True
+        )
+        on_token = self.callback.on_llm_new_token if self.callback else None
+        parts = []
+        with stream:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if token:
+                    parts.append(token)
+                    if on_token:
+                        on_token(token)
+        if self.callback:
+            self.callback.on_llm_end()
+        response = "".join(parts)
+        self.memory.save_context({"input": _input}, {"response": response})
+        return response
+
+    async def arun(self, _input):
+        completion = await async_openai_client().chat.completions.create(
+            model=self.model, temperature=self.temperature, messages=self.messages(_input)
+        )
+        response = completion.choices[0].message.content or ""
+        self.memory.save_context({"input": _input}, {"response": response})
+        return response
+
+
+@functools.lru_cache(maxsize=None)
+def cached_summarizer():
+    from typing import Any
+    from langchain.chat_models import ChatOpenAI
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    class CachedSummarizer(ChatOpenAI):
+        # Summaries go through the ResponseCache like turns, so a fully cached re-run makes no requests.
+        response_cache: Any = None
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            if self.response_cache is None:
+                return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            prompt = [[message.type, message.content] for message in messages]
+            key = self.response_cache.key(self.model_name, self.temperature, prompt)
+            text = self.response_cache.get(key)
+            if text is None:
+                result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                self.response_cache.put(key, result.generations[0].message.content)
+                return result
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    return CachedSummarizer
+
+
+def make_langchain_agent(model, temperature, template, memory, callback, streaming, client_options=None):
+    from langchain.chat_models import ChatOpenAI
+    from langchain.chains import ConversationChain
+    from langchain.prompts import PromptTemplate
+
+    if isinstance(memory, TranscriptView):
+        memory = langchain_transcript_memory()(view=memory)
+    client_options = dict(client_options or {})
+    if "timeout" in client_options:
+        client_options["request_timeout"] = client_options.pop("timeout")
+    llm = ChatOpenAI(
+        model=model, temperature=temperature, streaming=streaming,
+        callbacks=[langchain_callback_handler()(callback)] if callback else None,
+        **client_options,
+    )
+    return ConversationChain(
+        llm=llm,
+        memory=memory,
+        prompt=PromptTemplate(input_variables=["input", "history"], template=template)
+    )
+
+
+EXPERT_COLORS = ("blue", "magenta", "cyan", "yellow")
+
+
+def parse_expert(spec):
+    # NAME:MODEL:EXPERTISE
+    name, model, expertise = spec.split(":", 2)
+    return name, model, f"You are an expert in {expertise}."
+
+
+def make_speakers(topic, memory="buffer", history_tokens=2000, streaming=True, cache=None, backend="langchain",
+                  resilience=None, experts=()):
+    # Simplicio, Salvati and any extra (name, model, persona) experts, all sharing one transcript.
+    transcript = Transcript()
+    summary_llm = None
+    if memory != "buffer":
+        # The summarizer gets no streaming callbacks so summaries are not printed.
+        summary_llm = cached_summarizer()(model="gpt-3.5-turbo-16k", temperature=0, response_cache=cache)
+    group = bool(experts)
+
+    def make_speaker(name, color, model, template):
+        callback = Callback(color) if streaming else None
+        guard = Resilience(**resilience) if resilience is not None else None
+        client_options = guard.client_options() if guard else None
+        speaker_memory = make_memory(memory, history_tokens, transcript, name, summary_llm, names=group)
+        if backend == "native":
+            agent = NativeAgent(model, 0.7, Template(template), speaker_memory, callback, client_options)
+        else:
+            agent = make_langchain_agent(model, 0.7, template, speaker_memory, callback, streaming, client_options)
+        return Speaker(name, color, agent, model, 0.7, cache=cache, callback=callback, resilience=guard,
+                       transcript=transcript)
+
+    if not group:
+        simplicio = make_speaker("Simplicio", "red", "gpt-3.5-turbo-16k", simplicio_system_message.format(topic=topic))
+        salviati = make_speaker("Salvati", "green", "gpt-4", salvati_system_message)
+        return [simplicio, salviati]
+
+    panel = [("Salvati", "gpt-4", salvati_persona), *experts]
+    names = [name for name, _, _ in panel]
+    speakers = [make_speaker(
+        "Simplicio", "red", "gpt-3.5-turbo-16k",
+        simplicio_panel_system_message.format(topic=topic, experts=", ".join(names)),
+    )]
+    for (name, model, persona), color in zip(panel, itertools.cycle(("green", *EXPERT_COLORS))):
+        others = ", ".join(other for other in names if other != name) or "nobody else"
+        speakers.append(make_speaker(
+            name, color, model, expert_system_message.format(name=name, persona=persona, others=others)
+        ))
+    return speakers
+
+
+def print_cache_stats(cache):
+    stats = cache.stats()
+    print(colored(
+        f"[cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries, {stats['bytes']} bytes]",
+        "grey",
+    ))
+
+
+def fan_in(lines, group):
+    # The input for the next speaker: the latest line as is, or labelled lines when several people talk.
+    if not group:
+        return lines[-1][1]
+    return "\n\n".join(f"{name}:\n{text}" for name, text in lines)
+
+
+def memory_state(memory):
+    # The running summary of a summary or hybrid memory, logged with each turn so resuming need not summarize again.
+    if hasattr(memory, "moving_summary_buffer"):
+        return {"summary": memory.moving_summary_buffer, "kept": len(memory.chat_memory.messages)}
+    if hasattr(memory, "predict_new_summary"):
+        return {"summary": memory.buffer}
+    return None
+
+
+def restore_memory(memory, _input, response, state):
+    memory.chat_memory.add_user_message(_input)
+    memory.chat_memory.add_ai_message(response)
+    if "kept" in state:
+        messages = memory.chat_memory.messages
+        memory.chat_memory.messages = messages[len(messages) - state["kept"]:]
+        memory.moving_summary_buffer = state["summary"]
+    else:
+        memory.buffer = state["summary"]
+
+
+def resume_dialogue(path, speakers, scheduler):
+    # Rebuild every memory from a transcript log without calling the model.
+    _, records = TranscriptLog.read(path)
+    by_name = {speaker.name: speaker for speaker in speakers}
+    group = len(speakers) > 2
+    transcript = speakers[0].transcript
+    message = fan_in([("Panel", "Hello.")], group)
+    for _, lines in itertools.groupby(records, key=lambda record: record.get("round", record["turn"])):
+        lines = list(lines)
+        with transcript.round([record["speaker"] for record in lines]):
+            for record in lines:
+                if record["speaker"] not in by_name:
+                    raise ValueError(f"{path}: unknown speaker {record['speaker']}")
+                memory = by_name[record["speaker"]].agent.memory
+                if "memory" in record:
+                    restore_memory(memory, message, record["text"], record["memory"])
+                else:
+                    memory.save_context({"input": message}, {"response": record["text"]})
+        scheduler.seen(by_name[lines[-1]["speaker"]])
+        message = fan_in([(record["speaker"], record["text"]) for record in lines], group)
+    if not records:
+        return message, 0, 0, None
+    return message, len(records), records[-1].get("round", records[-1]["turn"]) + 1, records[-1]["speaker"]
+
+
+def take_turn(speaker, message, counting, report_tokens=False):
+    prompt_tokens = speaker.prompt_tokens(message) if counting else None
+    if report_tokens and not (speaker.callback and speaker.callback.silent):
+        print(colored(f"[prompt tokens: {prompt_tokens}]", "grey"))
+    started = time.time()
+    t0 = time.perf_counter()
+    response = speaker.run(message)
+    seconds = time.perf_counter() - t0
+    completion_tokens = speaker.completion_tokens(response) if counting else None
+    record = {
+        "speaker": speaker.name,
+        "text": response,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "started": started,
+        "seconds": seconds,
+    }
+    state = memory_state(speaker.agent.memory)
+    if state is not None:
+        record["memory"] = state
+    return response, record, t0
+
+
+def main(topic, memory="buffer", history_tokens=2000, report_tokens=False, turns=None, cache=None, log=None,
+         resume=None, metrics=None, metrics_file=None, backend="langchain", resilience=None, experts=(),
+         policy="round-robin", weights=None, panel=False):
+    speakers = make_speakers(
+        topic, memory, history_tokens, cache=cache, backend=backend, resilience=resilience, experts=experts
+    )
+    group = len(speakers) > 2
+    complete = make_completer(backend) if policy == "moderator" else None
+    scheduler = make_scheduler(policy, speakers, weights, complete)
+    simplicio, panellists = speakers[0], speakers[1:]
+
+    message = fan_in([("Panel", "Hello.")], group)
+    turn = 0
+    rounds = 0
+    last = None
+    if resume:
+        message, turn, rounds, last = resume_dialogue(resume, speakers, scheduler)
+        print(colored(f"[resumed {turn} turns from {resume}]", "grey"))
+        log = log or resume
+    transcript_log = TranscriptLog(log, topic, resume=log == resume) if log else None
+    counting = report_tokens or transcript_log or metrics
+
+    def finish(speaker, record, t0):
+        nonlocal turn
+        record = {"turn": turn, "round": rounds, **record}
+        if transcript_log:
+            transcript_log.write(record)
+        if metrics:
+            metrics.record(speaker, record["prompt_tokens"], record["completion_tokens"], t0, record["seconds"])
+            if metrics_file:
+                metrics.write(metrics_file)
+        turn += 1
+
+    executor = None
+    if panel:
+        # Panellists answer Simplicio at the same time, so each round takes as long as the slowest of them.
+        executor = ThreadPoolExecutor(max_workers=len(panellists))
+        for speaker in panellists:
+            speaker.callback.silent = True
+    try:
+        while turns is None or turn < turns:
+            if panel and last == simplicio.name:
+                # The last round stops at --turns, so only the first panellists answer it.
+                answering = panellists if turns is None else panellists[:turns - turn]
+                with simplicio.transcript.round([speaker.name for speaker in answering]):
+                    results = list(executor.map(
+                        lambda speaker: take_turn(speaker, message, counting, report_tokens), answering
+                    ))
+                for speaker, (response, record, t0) in zip(answering, results):
+                    print(colored(speaker.name, speaker.color))
+                    if report_tokens:
+                        print(colored(f"[prompt tokens: {record['prompt_tokens']}]", "grey"))
+                    print(colored(response, speaker.color))
+                    finish(speaker, record, t0)
+                message = fan_in([(speaker.name, response) for speaker, (response, _, _) in zip(answering, results)], group)
+                last = answering[-1].name
+            else:
+                speaker = simplicio if panel else scheduler.next(message)
+                print(colored(speaker.name, speaker.color))
+                response, record, t0 = take_turn(speaker, message, counting, report_tokens)
+                print()
+                finish(speaker, record, t0)
+                message = fan_in([(speaker.name, response)], group)
+                last = speaker.name
+            rounds += 1
+    finally:
+        if executor:
+            executor.shutdown()
+        if transcript_log:
+            transcript_log.close()
+        if cache is not None:
+            print_cache_stats(cache)
+        if metrics:
+            print(colored(metrics.summary(), "grey"))
+
+
+def read_topics(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def transcript_path(output_dir, index, topic):
+    slug = re.sub(r"[^a-z0-9]+", "-", topic.lower()).strip("-")[:60]
+    return os.path.join(output_dir, f"{index:04d}-{slug}.txt")
+
+
+async def run_dialogue(topic, turns, path, limiter_for, memory, history_tokens, cache, metrics, metrics_file, backend):
+    speakers = make_speakers(topic, memory, history_tokens, streaming=False, cache=cache, backend=backend)
+    for speaker in speakers:
+        speaker.limiter = limiter_for(speaker.model)
+
+    scheduler = RoundRobin(speakers)
+    message = "Hello."
+    with open(path, "w") as f:
+        f.write(f"{topic}\n\n")
+        for _ in range(turns):
+            speaker = scheduler.next(message)
+            prompt_tokens = speaker.prompt_tokens(message) if metrics else None
+            t0 = time.perf_counter()
+            message = await speaker.arun(message)
+            if metrics:
+                metrics.record(speaker, prompt_tokens, speaker.completion_tokens(message), t0, time.perf_counter() - t0)
+                if metrics_file:
+                    metrics.write(metrics_file)
+            f.write(f"{speaker.name}\n{message}\n")
+            f.flush()
+
+
+async def run_batch(topics, turns, output_dir, concurrency=8, model_concurrency=None, rpm=None, tpm=None,
+                    memory="buffer", history_tokens=2000, cache=None, metrics=None, metrics_file=None,
+                    backend="langchain"):
+    os.makedirs(output_dir, exist_ok=True)
+    dialogues = asyncio.Semaphore(concurrency)
+    limiters = {}
+
+    def limiter_for(model):
+        if model not in limiters:
+            limiters[model] = RateLimiter(model_concurrency or concurrency, rpm, tpm)
+        return limiters[model]
+
+    async def run_one(index, topic):
+        path = transcript_path(output_dir, index, topic)
+        async with dialogues:
+            try:
+                await run_dialogue(
+                    topic, turns, path, limiter_for, memory, history_tokens, cache, metrics, metrics_file, backend
+                )
+            except Exception as e:
+                print(colored(f"failed: {topic}: {e!r}", "red"))
+            else:
+                print(colored(f"done: {topic} -> {path}", "green"))
+
+    await asyncio.gather(*(run_one(i, topic) for i, topic in enumerate(topics)))
+    client = async_openai_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+    if cache is not None:
+        print_cache_stats(cache)
+    if metrics:
+        print(colored(metrics.summary(), "grey"))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="An ode to Galileo")
 
-    parser.add_argument("topic", type=str, help="Topic of the variation")
+    parser.add_argument("topic", type=str, nargs="?", help="Topic of the variation")
     parser.add_argument("--api_key", type=str, help="OpenAI api key")
+    parser.add_argument("--backend", choices=BACKENDS, default="langchain", help="Call OpenAI through langchain or directly")
+    parser.add_argument("--memory", choices=MEMORY_MODES, default="buffer", help="Conversation memory mode")
+    parser.add_argument("--history-tokens", type=int, default=2000, help="Token budget for verbatim history in window/hybrid memory")
+    parser.add_argument("--report-tokens", action="store_true", help="Print the prompt token count of every turn")
+    parser.add_argument("--turns", type=int, help="Stop after this many turns (required with --topics-file)")
+    parser.add_argument("--topics-file", type=str, help="Run one dialogue per line of this file concurrently")
+    parser.add_argument("--output-dir", type=str, default="transcripts", help="Directory for batch transcripts")
+    parser.add_argument("--concurrency", type=int, default=8, help="Dialogues running at once in batch mode")
+    parser.add_argument("--model-concurrency", type=int, help="Concurrent requests per model in batch mode")
+    parser.add_argument("--rpm", type=int, help="Requests per minute per model in batch mode")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute per model in batch mode")
+    parser.add_argument("--cache", type=str, help="SQLite file for caching completions between runs")
+    parser.add_argument("--cache-max-mb", type=float, help="Evict least recently used completions above this size")
+    parser.add_argument("--cache-max-age-days", type=float, help="Evict completions not used for this many days")
+    parser.add_argument("--log", type=str, help="Append every completed turn to this JSONL transcript log")
+    parser.add_argument("--resume", type=str, help="Continue the dialogue recorded in this JSONL transcript log")
+    parser.add_argument("--metrics", action="store_true", help="Record per-turn latency, token and cost metrics")
+    parser.add_argument("--metrics-file", type=str, help="Rewrite this Prometheus text file after every turn")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port")
+    parser.add_argument("--ttft-timeout", type=float, default=60.0, help="Retry a turn with no first token after this many seconds")
+    parser.add_argument("--stall-timeout", type=float, default=30.0, help="Retry a turn whose stream pauses for this many seconds")
+    parser.add_argument("--retries", type=int, default=5, help="Retries per turn on stalls, rate limits and server errors")
+    parser.add_argument("--hedge", action="store_true", help="Race a duplicate request when the first token is slower than usual")
+    parser.add_argument("--hedge-quantile", type=float, default=0.95, help="Time to first token quantile that triggers a hedge")
+    parser.add_argument("--expert", action="append", default=[], metavar="NAME:MODEL:EXPERTISE", help="Add an expert next to Salvati (repeatable)")
+    parser.add_argument("--policy", choices=POLICIES, default="round-robin", help="How the next speaker is chosen")
+    parser.add_argument("--weights", type=float, nargs="+", help="Speaker weights for --policy weighted, Simplicio first")
+    parser.add_argument("--panel", action="store_true", help="Let Salvati and every expert answer each of Simplicio's questions at once")
 
     args = parser.parse_args()
 
     if args.api_key:
         os.environ["OPENAI_API_KEY"] = args.api_key
 
-    main(args.topic)
+    if args.resume and not args.topic:
+        try:
+            args.topic = TranscriptLog.read(args.resume)[0]["topic"]
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    if not args.topics_file and not args.topic:
+        parser.error("a topic or --topics-file is required")
+    if args.log and args.log != args.resume and os.path.exists(args.log) and os.path.getsize(args.log) > 0:
+        parser.error(f"--log {args.log} already holds a dialogue; continue it with --resume or log to a new file")
+    if args.topics_file and not args.turns:
+        parser.error("--topics-file requires --turns")
+    if args.backend == "native" and args.memory != "buffer":
+        parser.error("--backend native only supports --memory buffer")
+    try:
+        experts = [parse_expert(spec) for spec in args.expert]
+    except ValueError:
+        parser.error("--expert takes NAME:MODEL:EXPERTISE")
+    if args.panel and (args.policy != "round-robin" or args.weights):
+        parser.error("--panel always alternates Simplicio and the panel, so it takes no --policy or --weights")
+    if args.weights and len(args.weights) != len(experts) + 2:
+        parser.error("--weights needs one weight per speaker, Simplicio and Salvati first")
+    if args.weights and min(args.weights) <= 0:
+        parser.error("--weights must all be positive")
+    if args.topics_file and (experts or args.panel or args.policy != "round-robin" or args.weights):
+        parser.error("--topics-file runs Simplicio and Salvati in turn, so it takes no --expert, --panel, --policy or --weights")
+
+    cache = None
+    if args.cache:
+        cache = ResponseCache(
+            args.cache,
+            max_bytes=args.cache_max_mb * 1024 * 1024 if args.cache_max_mb else None,
+            max_age=args.cache_max_age_days * 86400 if args.cache_max_age_days else None,
+        )
+
+    metrics = None
+    if args.metrics or args.metrics_file or args.metrics_port:
+        metrics = Metrics()
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+
+    if args.topics_file:
+        asyncio.run(run_batch(
+            read_topics(args.topics_file), args.turns, args.output_dir,
+            concurrency=args.concurrency, model_concurrency=args.model_concurrency, rpm=args.rpm, tpm=args.tpm,
+            memory=args.memory, history_tokens=args.history_tokens, cache=cache,
+            metrics=metrics, metrics_file=args.metrics_file, backend=args.backend,
+        ))
+    else:
+        main(args.topic, memory=args.memory, history_tokens=args.history_tokens, report_tokens=args.report_tokens,
+             turns=args.turns, cache=cache, log=args.log, resume=args.resume, metrics=metrics,
+             metrics_file=args.metrics_file, backend=args.backend, experts=experts, policy=args.policy,
+             weights=args.weights, panel=args.panel, resilience={
+                 "ttft_timeout": args.ttft_timeout,
+                 "stall_timeout": args.stall_timeout,
+                 "retries": args.retries,
+                 "hedge": args.hedge,
+                 "hedge_quantile": args.hedge_quantile,
+             })
 
 
 